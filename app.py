@@ -1,13 +1,17 @@
 import streamlit as st
 import os
 import time
-from PIL import Image
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
 
 # Internal Script Imports
-from scripts.architect import RAGArchitect
-from scripts.vision_client import analyze_image
-from scripts.retriever import retrieve_poems, get_embedding
-from scripts.generator import generate_poem
+from scripts.architect import RAGArchitect, LocalReranker
+from scripts.vision_client import analyze_image, get_image_size
+from scripts.retriever import query_namespaces, get_embedding
+from scripts.generator import generate_poem_stream, GENERATOR_MODEL_ID, HQ_GENERATOR_MODEL_ID
 
 # Safe Import for Audio Only (Visualizer Removed for Stability)
 try:
@@ -65,31 +69,117 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Pinecone candidates handed to the reranker (its cost grows linearly with this)
+CANDIDATE_POOL_SIZE = 8
+
+# Narratives whose embedding + candidate pool a session keeps (each pool holds
+# CANDIDATE_POOL_SIZE full poems per poet)
+NARRATIVE_CACHE_SIZE = 4
+
+# --- DISPLAY HELPERS ---
+_POEM_POEM_RE = re.compile(r"poem\s+poem", re.IGNORECASE)
+PREVIEW_CHARS = 350
+
+def clean_title(raw_title: str) -> str:
+    """'poem poem_0042' -> 'Poem 0042' in a single pass."""
+    return _POEM_POEM_RE.sub("Poem", raw_title).replace("_", " ").title()
+
+def build_context_display(items):
+    """
+    Precomputes the (title, score label, preview) rows of the Context Data panel
+    once per reference selection, instead of re-deriving them on every rerun.
+    """
+    rows = []
+    for i, m in enumerate(items):
+        meta = m.get('metadata', {})
+        text = meta.get('text', "No text.").strip()
+
+        # Optional: Display Relevance Score if available (added by the reranker)
+        score_display = ""
+        if 'relevance_score' in m:
+            score_display = f" [Rel: {m['relevance_score']:.3f}]"
+
+        preview = text[:PREVIEW_CHARS] + '...' if len(text) > PREVIEW_CHARS else text
+        rows.append((clean_title(meta.get('title', f"{i+1}")), score_display, preview))
+    return rows
+
 # --- CACHING FUNCTIONS ---
-@st.cache_data(show_spinner=False)
-def run_vision_cached(image_file):
+# Bounded: one narrative per distinct image, evicted after an hour or past 64 images
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def _vision_by_hash(content_hash: str, _image_bytes: bytes):
     """
     Caches the expensive vision analysis call so reruns (like changing sliders)
-    don't re-trigger the Llama Vision model.
+    don't re-trigger the Llama Vision model. Streamlit keys the cache on
+    `content_hash` only (underscore args are skipped), so identical images
+    dedupe without re-hashing the full payload.
     """
     try:
-        # Save to temp file for the vision client to read
-        with open("temp_input.jpg", "wb") as f:
-            f.write(image_file.getbuffer())
-        return analyze_image("temp_input.jpg")
+        return analyze_image(_image_bytes)
     except Exception as e:
         return f"Error: {e}"
 
+def run_vision_cached(image_bytes: bytes):
+    """Computes the content hash once and delegates to the cached vision call."""
+    content_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    return _vision_by_hash(content_hash, image_bytes)
+
 # --- Session State Initialization ---
-# REMOVED: 'critique' from keys
-keys = ['narrative', 'retrieved_items', 'generated_poem', 'audio_bytes', 'last_upload_id']
-for k in keys:
-    if k not in st.session_state:
-        st.session_state[k] = None
+@dataclass
+class PipelineState:
+    """
+    Everything one browser session remembers, stored under a single session_state
+    key so a new upload is one object swap instead of a per-key reset.
+    """
+    narrative: Optional[str] = None
+    retrieved_items: Optional[List[Dict[str, Any]]] = None
+    context_display: Optional[List[tuple]] = None
+    retrieved_namespace: Optional[str] = None
+    generated_poem: Optional[str] = None
+    audio_bytes: Optional[bytes] = None
+    last_upload_id: Optional[str] = None
+    # Keyed by narrative hash; kept across uploads so re-uploads reuse them.
+    # LRU-bounded to NARRATIVE_CACHE_SIZE via lru_put.
+    candidate_pool: "OrderedDict[str, Dict[str, list]]" = field(default_factory=OrderedDict)
+    embeddings: "OrderedDict[str, List[float]]" = field(default_factory=OrderedDict)
+
+def lru_put(cache: OrderedDict, key: str, value) -> None:
+    """Stores value as the most recent entry and evicts the oldest beyond NARRATIVE_CACHE_SIZE."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > NARRATIVE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+if 'pipeline' not in st.session_state:
+    st.session_state.pipeline = PipelineState()
+
+# Initialize Architect (Process-wide singleton, shared across sessions)
+@st.cache_resource(show_spinner=False)
+def get_architect():
+    """
+    Builds the reranker once per server process so every browser session reuses
+    the same Cohere HTTP client (or local ONNX session) instead of rebuilding it.
+    Set RERANKER_BACKEND=local to rerank offline with the ONNX cross-encoder.
+    """
+    if os.getenv("RERANKER_BACKEND", "cohere").lower() == "local":
+        try:
+            return LocalReranker()
+        # Missing extras, a failed model download, a failed ONNX export or an
+        # unloadable session (onnxruntime errors aren't OSError/RuntimeError)
+        except Exception as e:
+            print(f"[WARNING] Local reranker unavailable ({e}). Falling back to Cohere.")
+    return RAGArchitect()
+
+architect = get_architect()
+# UI label for whichever backend actually loaded
+reranker_name = "Local ONNX" if isinstance(architect, LocalReranker) else "Cohere"
 
-# Initialize Architect (Lazy Loading)
-if 'rag_architect' not in st.session_state:
-    st.session_state.rag_architect = RAGArchitect()
+@st.cache_resource(show_spinner=False)
+def get_audio_engine():
+    """
+    One AudioEngine per server process. Per-poem state lives in the StanzaStream
+    returned by synthesize_stream, so sharing the engine across sessions is safe.
+    """
+    return AudioEngine()
 
 # ==========================================
 # 1. SIDEBAR (Controls Only)
@@ -131,15 +221,22 @@ with st.sidebar:
     st.markdown("---")
     if st.button("System Reset"):
         st.cache_data.clear()
-        for k in keys: st.session_state[k] = None
+        architect.cache.clear()
+        st.session_state.pipeline = PipelineState()
         st.rerun()
 
+    rerank_stats = architect.get_stats()
+    st.caption(
+        f"Rerank cache: {rerank_stats['size']}/{rerank_stats['max_size']} entries | "
+        f"hit rate {rerank_stats['hit_rate']:.0%} ({rerank_stats['hits']} hits, {rerank_stats['misses']} misses)"
+    )
+
 # ==========================================
 # MAIN LOGIC
 # ==========================================
 st.title("Poetic Camera")
 # UPDATED: Reflected new mode
-st.caption("System Status: Online | Mode: Production RAG (Cohere Powered)")
+st.caption(f"System Status: Online | Mode: Production RAG ({reranker_name} Powered: {architect.model})")
 
 # --- CAMERA HANDLING ---
 image_source = None
@@ -148,7 +245,7 @@ if input_method == "Upload":
     image_source = sidebar_upload
 elif input_method == "Camera":
     # --- CAMERA IN MAIN AREA ---
-    with st.expander("Open Viewfinder", expanded=(st.session_state.last_upload_id is None)):
+    with st.expander("Open Viewfinder", expanded=(st.session_state.pipeline.last_upload_id is None)):
         camera_shot = st.camera_input("Capture Scene")
         if camera_shot:
             image_source = camera_shot
@@ -156,15 +253,18 @@ elif input_method == "Camera":
 # --- PROCESSING PIPELINE ---
 if image_source:
     
+    # Read the upload once; vision, preview and metadata all reuse these bytes
+    image_bytes = image_source.getvalue()
+
     # Check for new file to reset state
     file_id = f"{image_source.name}_{image_source.size}"
-    if st.session_state.last_upload_id != file_id:
-        st.session_state.narrative = None
-        st.session_state.retrieved_items = None
-        st.session_state.generated_poem = None
-        st.session_state.audio_bytes = None 
-        # REMOVED: st.session_state.critique cleanup
-        st.session_state.last_upload_id = file_id
+    state = st.session_state.pipeline
+    if state.last_upload_id != file_id:
+        state = st.session_state.pipeline = PipelineState(
+            last_upload_id=file_id,
+            candidate_pool=state.candidate_pool,
+            embeddings=state.embeddings
+        )
 
     # Layout: 3 Columns
     col1, col2, col3 = st.columns([1, 1, 1], gap="medium")
@@ -175,11 +275,12 @@ if image_source:
             st.subheader("I. Ingestion")
             
             # Display Image
-            st.image(image_source)
+            st.image(image_bytes)
             
-            # Metadata
-            img = Image.open(image_source)
-            st.caption(f"Res: {img.size[0]} x {img.size[1]} px")
+            # Metadata (parsed from the header bytes, no decode)
+            img_size = get_image_size(image_bytes)
+            if img_size:
+                st.caption(f"Res: {img_size[0]} x {img_size[1]} px")
 
     # --- CARD 2: INTERNAL MONOLOGUE ---
     with col2:
@@ -187,57 +288,80 @@ if image_source:
             st.subheader("II. Processing")
             
             # 1. Vision Analysis
-            if not st.session_state.narrative:
+            if not state.narrative:
                 with st.status("[SYSTEM] Initializing Vision Pipeline...", expanded=True) as s:
                     st.write("Task: Image Analysis (Llama 3.2 Vision)")
                     
                     # Capture the result
-                    result = run_vision_cached(image_source) 
-                    st.session_state.narrative = result
+                    result = run_vision_cached(image_bytes)
+                    state.narrative = result
                     
                     s.update(label="[SYSTEM] Vision Analysis: Complete", state="complete", expanded=False)
             
             # --- ERROR HANDLING & RETRIEVAL ---
-            if not st.session_state.narrative:
+            if not state.narrative:
                 st.error("Vision Analysis returned no data. Check logs.")
             
             # Check for explicit error
-            elif st.session_state.narrative.startswith("ERROR:") or "Error:" in st.session_state.narrative:
-                st.error(f"Pipeline Failed: {st.session_state.narrative}")
+            elif state.narrative.startswith("ERROR:") or "Error:" in state.narrative:
+                st.error(f"Pipeline Failed: {state.narrative}")
                 st.stop() 
             
             # Proceed if valid
             else:
-                st.info(f"**Narrative:** {st.session_state.narrative}")
+                st.info(f"**Narrative:** {state.narrative}")
+
+                # Switching poets re-selects references from the cached candidate pool
+                if state.retrieved_namespace != target_namespace:
+                    state.retrieved_items = None
+                    state.generated_poem = None
+                    state.audio_bytes = None
 
                 # 2. Memory Retrieval
-                if not st.session_state.retrieved_items:
+                if not state.retrieved_items:
                     with st.status("[SYSTEM] Architect: Selecting References...", expanded=True) as s:
                     
-                        st.write(f"1. Retrieving top 15 candidates from namespace: {target_namespace}...")
-                        
-                        raw_candidates = retrieve_poems(
-                            st.session_state.narrative, 
-                            top_k=15, 
-                            namespace=target_namespace 
-                        )
+                        # All poet namespaces are fetched in one concurrent fan-out and
+                        # kept per narrative, so toggling the poet skips Pinecone entirely.
+                        narrative_key = hashlib.blake2b(state.narrative.encode(), digest_size=16).hexdigest()
+                        if narrative_key not in state.candidate_pool:
+                            # The narrative is deterministic per image: embed it once and
+                            # reuse the vector if the search has to be retried.
+                            if not state.embeddings.get(narrative_key):
+                                lru_put(state.embeddings, narrative_key, get_embedding(state.narrative))
+
+                            st.write(f"1. Retrieving top {CANDIDATE_POOL_SIZE} candidates from namespaces: {', '.join(poet_map.values())}...")
+                            pool = query_namespaces(
+                                state.embeddings[narrative_key],
+                                list(poet_map.values()),
+                                top_k=CANDIDATE_POOL_SIZE
+                            )
+                            # Don't pin an empty pool (e.g. Pinecone outage); retry on next run
+                            if any(pool.values()):
+                                lru_put(state.candidate_pool, narrative_key, pool)
+                        else:
+                            state.candidate_pool.move_to_end(narrative_key)
+                            st.write(f"1. Reusing cached candidates for namespace: {target_namespace}...")
+
+                        raw_candidates = state.candidate_pool.get(narrative_key, {}).get(target_namespace, [])
                     
-                        # UPDATED: Text to reflect Cohere usage
-                        st.write("2. Cohere Architect: Semantic Re-ranking...")
-                        selected_candidates = st.session_state.rag_architect.select_best_candidates(
-                            st.session_state.narrative, 
+                        st.write(f"2. {reranker_name} Architect: Semantic Re-ranking...")
+                        selected_candidates = architect.select_best_candidates(
+                            state.narrative, 
                             raw_candidates,
                             top_k=3
                         )
                     
-                        st.session_state.retrieved_items = selected_candidates
+                        state.retrieved_items = selected_candidates
+                        state.context_display = build_context_display(selected_candidates)
+                        state.retrieved_namespace = target_namespace
                         s.update(label="[SYSTEM] Reference Selection Complete", state="complete", expanded=False)
             
                 # Persistent State (If data exists)
                 else:
                     with st.status("[SYSTEM] Memory Active", state="complete", expanded=False):
                         st.write("1. Vector Search: Complete")
-                        st.write("2. Cohere Reranking: Complete")
+                        st.write(f"2. {reranker_name} Reranking: Complete")
 
     # --- CARD 3: GENERATIVE INFERENCE ---
     with col3:
@@ -247,71 +371,62 @@ if image_source:
             # Initialize temperature to a default to prevent 'UnboundLocalError'
             temperature = 0.5 
             
-            if st.session_state.retrieved_items:
+            if state.retrieved_items:
                 
                 st.markdown("#### Parameters")
                 temperature = st.slider("Model creative freedom", 0.1, 1.0, 0.5)
+                hq_mode = st.checkbox("HQ mode (Llama 3.3 70B, slower)", value=False)
                 
                 with st.expander("Context Data"):
-                    for i, m in enumerate(st.session_state.retrieved_items):
-                        meta = m.get('metadata', {})
-                        raw_title = meta.get('title', f"{i+1}")
-                        clean_text = meta.get('text', "No text.").strip()
-                        
-                        # Optional: Display Relevance Score if available (added by Cohere)
-                        score_display = ""
-                        if 'relevance_score' in m:
-                            score_display = f" [Rel: {m['relevance_score']:.3f}]"
-
-                        # Clean up title formatting
-                        clean_title = raw_title
-                        if "poem poem" in clean_title.lower():
-                            clean_title = clean_title.lower().replace("poem poem", "Poem").title()
-                        clean_title = clean_title.replace("_", " ").title()
-
-                        st.markdown(f"**{clean_title}**{score_display}")
-                        st.caption(f"{clean_text[:350] + '...' if len(clean_text) > 350 else clean_text}") 
+                    for title, score_display, preview in state.context_display:
+                        st.markdown(f"**{title}**{score_display}")
+                        st.caption(preview)
                         st.divider()
                 
                 # --- BUTTON LOGIC ---
                 st.markdown("---")
                 if st.button("Generate poem with voice", type="primary", use_container_width=True):
                 
-                    # 1. TEXT GENERATION
-                    with st.status("Drafting Poem...", expanded=True) as status:
-                        st.write(f"Task: Text Inference (Style: {selected_poet_name})")
-                    
-                        st.session_state.generated_poem = generate_poem(
-                            st.session_state.narrative,
-                            st.session_state.retrieved_items,
-                            poet_name=selected_poet_name,
-                            temperature=temperature
-                        )
-                        
-                        # REMOVED: Critique Logic Block
-                        
-                        status.update(label="Poem Drafted!", state="complete", expanded=False)
+                    # 1. TEXT GENERATION (streamed; stanzas are voiced as soon as they close)
+                    status = st.status("Drafting Poem...", expanded=False)
+                    status.write(f"Task: Text Inference (Style: {selected_poet_name})")
+                    poem_placeholder = st.empty()
+
+                    poem_stream = generate_poem_stream(
+                        state.narrative,
+                        state.retrieved_items,
+                        poet_name=selected_poet_name,
+                        temperature=temperature,
+                        model=HQ_GENERATOR_MODEL_ID if hq_mode else GENERATOR_MODEL_ID
+                    )
+
+                    audio_stream = None
+                    if AUDIO_AVAILABLE:
+                        audio_stream = get_audio_engine().synthesize_stream(poem_stream)
+                        poem_stream = audio_stream
+
+                    state.generated_poem = poem_placeholder.write_stream(poem_stream)
+                    status.update(label="Poem Drafted!", state="complete", expanded=False)
 
                     # 2. RENDER POEM
-                    if st.session_state.generated_poem:
-                        clean_poem = st.session_state.generated_poem.replace("- ", "— ")
+                    if state.generated_poem:
+                        clean_poem = state.generated_poem.replace("- ", "— ")
                     
-                        st.markdown(
+                        poem_placeholder.markdown(
                             f"<div style='text-align: center; font-style: italic; padding: 10px; font-family: serif; white-space: pre-wrap;'>{clean_poem}</div>", 
                             unsafe_allow_html=True
                         )
                         
                         # REMOVED: Critique Scorecard Display
 
-                    # 3. AUDIO GENERATION
-                    if AUDIO_AVAILABLE and st.session_state.generated_poem:
+                    # 3. AUDIO GENERATION (most stanzas are already synthesized by now)
+                    if audio_stream is not None and state.generated_poem:
                         audio_placeholder = st.empty()
                         with audio_placeholder.status("Synthesizing Audio...", expanded=False) as audio_status:
-                            audio = AudioEngine()
-                            st.session_state.audio_bytes = audio.synthesize(st.session_state.generated_poem)
+                            state.audio_bytes = audio_stream.audio()
                             audio_status.update(label="Audio Ready", state="complete")
                     
-                        if st.session_state.audio_bytes:
-                            audio_placeholder.audio(st.session_state.audio_bytes, format="audio/mpeg")
+                        if state.audio_bytes:
+                            audio_placeholder.audio(state.audio_bytes, format="audio/mpeg")
             else:
                 st.info("Waiting for Vision Analysis to retrieve memories...")
\ No newline at end of file
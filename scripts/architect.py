@@ -1,10 +1,79 @@
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 import cohere
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 
+__all__ = ["RAGArchitect", "LocalReranker", "QueryCache"]
+
+# If the best vector match beats the top_k-th match by this ratio, the
+# bi-encoder ranking is already decisive and the Cohere call is skipped.
+SKIP_RERANK_RATIO = 1.15
+
+# Cross-encoder cost scales with passage length; the opening of a poem is
+# enough signal to rank it against a one-sentence scene description.
+MAX_DOC_CHARS = 1500
+
+# Local (offline) reranker, selected with RERANKER_BACKEND=local
+LOCAL_RERANK_MODEL_ID = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+LOCAL_RERANK_DIR = os.getenv("LOCAL_RERANK_DIR", "models/ms-marco-minilm-int8")
+
+class QueryCache:
+    """
+    Thread-safe LRU cache with a TTL, used to memoize rerank results.
+    The architect is shared across sessions, so every access takes the lock.
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._store: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._store[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._store[key] = (value, time.monotonic())
+            self._store.move_to_end(key)
+            while len(self._store) > self.max_size:
+                self._store.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._store.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._store),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
 class RAGArchitect:
     """
     The 'Discriminator' of the RAG pipeline.
@@ -20,6 +89,8 @@ class RAGArchitect:
             
         self.client = cohere.Client(self.api_key)
         self.model = "rerank-english-v3.0" 
+        self.cache = QueryCache(max_size=128, ttl=600)
+        print(f"[SYSTEM] Reranker ready: {type(self).__module__}.{type(self).__name__} ({type(self.client).__name__}, {self.model})")
 
     def select_best_candidates(self, vision_narrative: str, candidates: List[Dict], top_k: int = 3) -> List[Dict]:
         """
@@ -35,34 +106,130 @@ class RAGArchitect:
         """
         if not candidates:
             return []
+
+        # 0. Early exit on clear-cut queries (Pinecone matches arrive sorted by score)
+        if len(candidates) >= top_k:
+            best = candidates[0].get('score', 0.0)
+            cutoff = candidates[top_k - 1].get('score', 0.0)
+            if cutoff > 0 and best > SKIP_RERANK_RATIO * cutoff:
+                print(f"\nSkipping rerank: top match {best:.4f} dominates #{top_k} ({cutoff:.4f}).")
+                return candidates[:top_k]
             
-        print(f"\nReranking {len(candidates)} candidates via Cohere reranker 3.5->\nTop 3: ")
+        print(f"\nReranking {len(candidates)} candidates via {self.model}->\nTop {top_k}: ")
 
         # 1. Prepare Documents for the API
-        # Cohere expects a list of strings. We extract the text content.
-        docs_text = [doc.get('metadata', {}).get('text', '') for doc in candidates]
+        # Cohere expects a list of strings. We extract (and truncate) the text content.
+        docs_text = [(doc.get('metadata', {}).get('text', '') or '')[:MAX_DOC_CHARS] for doc in candidates]
+
+        # Same narrative + same documents -> same ranking, so reruns and poet
+        # switches back to an already-ranked pool never reach the API.
+        cache_key = hashlib.blake2b(
+            "\x00".join([self.model, str(top_k), vision_narrative, *docs_text]).encode(),
+            digest_size=16
+        ).hexdigest()
 
         try:
-            # 2. Call the API
-            response = self.client.rerank(
-                model=self.model,
-                query=vision_narrative,
-                documents=docs_text,
-                top_n=top_k
-            )
+            ranked = self.cache.get(cache_key)
+
+            if ranked is None:
+                # 2. Score the documents
+                ranked = self._rank(vision_narrative, docs_text, top_k)
+                self.cache.put(cache_key, ranked)
+            else:
+                print("(cached)")
             
             # 3. Map Results back to Original Objects
             # Cohere returns indices (e.g., "Document 4 is #1"). 
             # We use these indices to grab the original full dictionary from 'candidates'.
             ranked_candidates = []
             
-            for result in response.results:
-                original_doc = candidates[result.index]
-                print(f"[{original_doc.get('metadata', {}).get('title', '').lower().replace('poem poem', 'Poem')} : {result.index}]")
+            for idx, score in ranked:
+                original_doc = candidates[idx]
+                print(f"[{original_doc.get('metadata', {}).get('title', '').lower().replace('poem poem', 'Poem')} : {idx} ({score:.3f})]")
                 ranked_candidates.append(original_doc)
 
             return ranked_candidates
 
         except Exception as e:
-            print(f"[ERROR] Cohere Rerank failed: {e}")
+            print(f"[ERROR] Rerank ({self.model}) failed: {e}")
             return candidates[:top_k]
+
+    def _rank(self, vision_narrative: str, docs_text: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """
+        Returns (candidate index, relevance score) pairs, best first.
+        """
+        response = self.client.rerank(
+            model=self.model,
+            query=vision_narrative,
+            documents=docs_text,
+            top_n=top_k,
+            max_chunks_per_doc=1
+        )
+        return [(result.index, result.relevance_score) for result in response.results]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Rerank cache statistics, for observability."""
+        return self.cache.get_stats()
+
+class LocalReranker(RAGArchitect):
+    """
+    Drop-in, offline replacement for the Cohere reranker.
+
+    Runs an INT8-quantized MiniLM cross-encoder through ONNX Runtime on CPU,
+    scoring all (narrative, poem) pairs in a single session.run call.
+    Requires the optional `onnxruntime`, `transformers` and (for the one-time
+    export) `optimum[onnxruntime]` packages.
+    """
+
+    def __init__(self, model_id: str = LOCAL_RERANK_MODEL_ID, model_dir: str = LOCAL_RERANK_DIR):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            self._export_quantized(model_id, model_dir)
+
+        self.model = model_id
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # The fast tokenizer mutates its padding/truncation state on every call and
+        # raises "Already borrowed" when sessions share it; session.run is thread-safe
+        self._tokenizer_lock = threading.Lock()
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.cache = QueryCache(max_size=128, ttl=600)
+        print(f"[SYSTEM] Reranker ready: {type(self).__module__}.{type(self).__name__} (onnxruntime, {self.model})")
+
+    @staticmethod
+    def _export_quantized(model_id: str, model_dir: str) -> None:
+        """
+        One-time ONNX export + dynamic INT8 quantization of the cross-encoder.
+        """
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        print(f"[SYSTEM] Exporting {model_id} to INT8 ONNX in {model_dir}...")
+        model = ORTModelForSequenceClassification.from_pretrained(model_id, export=True)
+        model.save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+
+    def _rank(self, vision_narrative: str, docs_text: List[str], top_k: int) -> List[Tuple[int, float]]:
+        # One batch for all pairs amortizes the per-call session overhead
+        with self._tokenizer_lock:
+            encoded = self.tokenizer(
+                [vision_narrative] * len(docs_text),
+                docs_text,
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors="np"
+            )
+        feeds = {name: value for name, value in encoded.items() if name in self.input_names}
+        logits = self.session.run(None, feeds)[0][:, 0]
+
+        order = sorted(range(len(docs_text)), key=lambda i: logits[i], reverse=True)[:top_k]
+        return [(i, float(logits[i])) for i in order]
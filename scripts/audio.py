@@ -1,11 +1,17 @@
 from gtts import gTTS
 import io
-from typing import Optional
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+# Blank line(s) between stanzas
+STANZA_BREAK = re.compile(r"\n\s*\n")
 
 class AudioEngine:
     """
     Handles Text-to-Speech using Google TTS (gTTS).
-    Synchronous implementation for maximum stability on Streamlit Cloud.
+    Each synthesize() call is blocking; synthesize_stream() runs them per
+    stanza on a small thread pool while the poem is still streaming.
     """
 
     def __init__(self, output_dir: str = "assets/audio"):
@@ -47,4 +53,52 @@ class AudioEngine:
 
         except Exception as e:
             print(f"[ERROR] gTTS Failed: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def synthesize_stream(self, chunks: Iterable[str]) -> "StanzaStream":
+        """
+        Wraps a streaming text source so each stanza is voiced as soon as it closes.
+        """
+        return StanzaStream(self, chunks)
+
+class StanzaStream:
+    """
+    Passes streamed text through untouched while synthesizing every completed
+    stanza on a background thread, so first-audio latency is roughly
+    first stanza + its TTS instead of full generation + full TTS.
+    """
+
+    def __init__(self, engine: AudioEngine, chunks: Iterable[str], max_workers: int = 4):
+        self.engine = engine
+        self.chunks = chunks
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._buffer = ""
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self.chunks:
+            self._buffer += chunk
+            *closed, self._buffer = STANZA_BREAK.split(self._buffer)
+            for stanza in closed:
+                self._submit(stanza)
+            yield chunk
+
+        # Whatever is left after the stream ends is the final stanza
+        self._submit(self._buffer)
+        self._buffer = ""
+
+    def _submit(self, stanza: str) -> None:
+        if stanza.strip():
+            self._futures.append(self._executor.submit(self.engine.synthesize, stanza.strip()))
+
+    def audio(self) -> Optional[bytes]:
+        """
+        Waits for the outstanding stanzas and returns the stitched MP3 bytes.
+        """
+        segments = [future.result() for future in self._futures]
+        self._executor.shutdown(wait=False)
+
+        # MP3 frames are self-delimiting, so segments can be concatenated directly
+        if not segments or any(seg is None for seg in segments):
+            return None
+        return b"".join(segments)
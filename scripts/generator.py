@@ -1,11 +1,20 @@
 import os
-from typing import List, Dict
+import functools
+from typing import Dict, Iterator, List
 from groq import Groq
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Fast default: poem quality is driven mostly by the style references.
+# The 70B model stays available as an opt-in "HQ mode".
+GENERATOR_MODEL_ID = os.getenv("GENERATOR_MODEL_ID", "llama-3.1-8b-instant")
+HQ_GENERATOR_MODEL_ID = "llama-3.3-70b-versatile"
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> Groq:
+    """Lazily builds a single Groq client (and its connection pool) per process."""
+    return Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 # --- STYLE CONFIGURATION ---
 POET_PROMPTS = {
@@ -38,25 +47,10 @@ POET_PROMPTS = {
     """
 }
 
-def generate_poem(vision_narrative: str, reference_poems: List[Dict], poet_name: str, temperature: float = 0.6) -> str:
-    """
-    Dynamically generates a poem based on the selected poet's persona.
-    """
-    
-    # 1. Get the specific system prompt (Default to Dickinson if not found)
-    system_instruction = POET_PROMPTS.get(poet_name, POET_PROMPTS["Emily Dickinson"])
-
-    reference_text = ""
-    for i, item in enumerate(reference_poems):
-        meta = item['metadata']
-        text = meta.get('text', '')
-        reference_text += f"\n--- Reference {i+1} ---\n{text}\n"
-
-    print(f"Ghost Writer initialized for {poet_name} with {len(reference_poems)} references.")
-
-    # 2. Dynamic System Prompt
-    system_prompt = f"""
-    {system_instruction}
+# Fully assembled system prompt per poet, built once at import
+POET_SYSTEM_PROMPTS = {
+    name: f"""
+    {instruction}
     
     Your task: observe a scene (described to you) and write a NEW poem about it.
     
@@ -65,7 +59,27 @@ def generate_poem(vision_narrative: str, reference_poems: List[Dict], poet_name:
     2. Do NOT copy the references. Use them only as a "style transfer" source.
     3. Do not output any intro text. Just the poem.
     """
+    for name, instruction in POET_PROMPTS.items()
+}
+
+FALLBACK_POEM = "The camera is blind,\nThe words wont find,\nA path to you."
+
+def build_messages(vision_narrative: str, reference_poems: List[Dict], poet_name: str) -> List[Dict[str, str]]:
+    """
+    Assembles the chat messages for the selected poet's persona.
+    """
+    
+    # 1. Get the specific system prompt (Default to Dickinson if not found)
+    system_prompt = POET_SYSTEM_PROMPTS.get(poet_name, POET_SYSTEM_PROMPTS["Emily Dickinson"])
+
+    reference_text = "".join(
+        f"\n--- Reference {i+1} ---\n{item['metadata'].get('text', '')}\n"
+        for i, item in enumerate(reference_poems)
+    )
 
+    print(f"Ghost Writer initialized for {poet_name} with {len(reference_poems)} references.")
+
+    # 2. Dynamic User Prompt
     user_prompt = f"""
     SCENE OBSERVED:
     {vision_narrative}
@@ -75,14 +89,20 @@ def generate_poem(vision_narrative: str, reference_poems: List[Dict], poet_name:
 
     Write the poem now:
     """
-    
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def generate_poem(vision_narrative: str, reference_poems: List[Dict], poet_name: str, temperature: float = 0.6, model: str = GENERATOR_MODEL_ID) -> str:
+    """
+    Dynamically generates a poem based on the selected poet's persona.
+    """
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            model="llama-3.3-70b-versatile",
+        chat_completion = get_client().chat.completions.create(
+            messages=build_messages(vision_narrative, reference_poems, poet_name),
+            model=model,
             temperature=temperature,
             max_tokens=300, 
         )
@@ -91,4 +111,27 @@ def generate_poem(vision_narrative: str, reference_poems: List[Dict], poet_name:
 
     except Exception as e:
         print(f"Generation Failed: {e}")
-        return "The camera is blind,\nThe words wont find,\nA path to you."
\ No newline at end of file
+        return FALLBACK_POEM
+
+def generate_poem_stream(vision_narrative: str, reference_poems: List[Dict], poet_name: str, temperature: float = 0.6, model: str = GENERATOR_MODEL_ID) -> Iterator[str]:
+    """
+    Same as generate_poem, but yields text deltas as Groq produces them so the
+    UI (and TTS) can start before the full poem is written.
+    """
+    try:
+        stream = get_client().chat.completions.create(
+            messages=build_messages(vision_narrative, reference_poems, poet_name),
+            model=model,
+            temperature=temperature,
+            max_tokens=300,
+            stream=True,
+        )
+
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    except Exception as e:
+        print(f"Generation Failed: {e}")
+        yield FALLBACK_POEM
@@ -0,0 +1,134 @@
+import os
+import re
+import glob
+import mmap
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator
+
+START_MARKER = b"*** START OF THE PROJECT GUTENBERG EBOOK"
+END_MARKER = b"*** END OF THE PROJECT GUTENBERG EBOOK"
+READ_BUFFER_SIZE = 1 << 17
+WRITE_BUFFER_SIZE = 1 << 20
+POEM_SEPARATOR = "\n---POEM_SEPARATOR---\n"
+
+# Short all-caps lines (roman numerals, section titles): under 20 chars,
+# at least one capital, no lowercase. Removed together with their newline.
+_HEADER_RE = re.compile(rb"^[ \t]*(?=[^\n]{1,19}$)[^a-z\n]*[A-Z][^a-z\n]*$\n?", re.MULTILINE)
+# Whitespace-only lines must count as blank lines for poem splitting
+# (\r included: the body is raw bytes, so CRLF is not translated)
+_BLANK = re.compile(rb"[ \t\r]+$", re.MULTILINE)
+# Three or more newlines separate poems
+_POEM_SEP = re.compile(rb"\n{3,}")
+# The same boundary in the raw body, before whitespace-only lines are blanked
+_RAW_POEM_SEP = re.compile(rb"\n(?:[ \t\r]*\n){2,}")
+
+def _slice_body(buf) -> bytes:
+    """Returns the bytes between the START marker line and the END marker."""
+    start = buf.find(START_MARKER)
+    # Skip the rest of the START marker line itself
+    start = buf.find(b"\n", start) + 1 if start != -1 else 0
+    end = buf.find(END_MARKER, start)
+    end = end if end != -1 else len(buf)
+    return buf[start:end]
+
+def load_body(path: str) -> bytes:
+    """
+    Reads only the book body, as raw bytes. The file is memory-mapped so the
+    Gutenberg markers are located without first reading the whole file.
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            body = _slice_body(mm)
+    except (ValueError, OSError):
+        # Empty files and pipes can't be mapped; fall back to a buffered read
+        with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+            return _slice_body(f.read())
+    return body
+
+def _clean_chunk(chunk: bytes) -> Iterator[str]:
+    chunk = _BLANK.sub(b"", chunk)
+    chunk = _HEADER_RE.sub(b"", chunk)
+    # Removing a header can merge the blank lines around it into a new boundary
+    for c in _POEM_SEP.split(chunk):
+        c = c.decode("utf-8").strip()
+        if len(c) > 30:
+            yield c
+
+def clean_and_split(content: bytes) -> Iterator[str]:
+    """
+    Yields the poems of the book body one at a time. The body is scanned once
+    for poem boundaries and each chunk is cleaned and decoded on its own, so
+    no cleaned copy of the whole book is ever built.
+    """
+    start = 0
+    for m in _RAW_POEM_SEP.finditer(content):
+        yield from _clean_chunk(content[start:m.start()])
+        start = m.end()
+    yield from _clean_chunk(content[start:])
+
+def write_poems(poems, path: str) -> int:
+    """
+    Streams poems to disk with the separator between them, so the joined
+    output never exists as one more full-size string. Returns the count.
+    """
+    count = 0
+    with open(path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        for count, poem in enumerate(poems, 1):
+            if count > 1:
+                f.write(POEM_SEPARATOR)
+            f.write(poem)
+    return count
+
+def process_one(path: str, out_path: str) -> int:
+    """Cleans one Gutenberg file into out_path. Module-level so worker processes can pickle it."""
+    return write_poems(clean_and_split(load_body(path)), out_path)
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="Raw Project Gutenberg .txt file")
+    source.add_argument("--input-glob", help="Glob of raw .txt files (e.g. 'raw/*.txt'), cleaned in parallel")
+    parser.add_argument("--output", help="Cleaned .txt file (input for metadata_extractor_dense)")
+    parser.add_argument("--output-dir", default=".", help="With --input-glob: where <name>_clean.txt files are written")
+    args = parser.parse_args()
+
+    # --- BATCH MODE ---
+    if args.input_glob:
+        paths = sorted(glob.glob(args.input_glob))
+        if not paths:
+            print(f"No files match: {args.input_glob}")
+            return
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        # Cleanup is pure-Python CPU work, so files go to separate processes, not threads
+        with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+            futures = {}
+            for path in paths:
+                stem = os.path.splitext(os.path.basename(path))[0]
+                out_path = os.path.join(args.output_dir, f"{stem}_clean.txt")
+                futures[executor.submit(process_one, path, out_path)] = (path, out_path)
+
+            for future in as_completed(futures):
+                path, out_path = futures[future]
+                try:
+                    print(f"Wrote {future.result()} poems from {path} to {out_path}")
+                except Exception as e:
+                    print(f"Failed to clean {path}: {e}")
+        return
+
+    # --- SINGLE FILE ---
+    if not args.output:
+        parser.error("--output is required with --input")
+
+    if not os.path.exists(args.input):
+        print(f"File not found: {args.input}")
+        return
+
+    print(f"Cleaning {args.input}...")
+    count = process_one(args.input, args.output)
+
+    print(f"Wrote {count} poems to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,116 +1,441 @@
 import os
-import json
+import orjson
 import time
+import asyncio
 import argparse
-from groq import Groq
+import hashlib
+from pathlib import Path
+from groq import AsyncGroq, RateLimitError
+from pydantic import BaseModel, Field, ValidationError, conlist
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 
 load_dotenv()
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 MODEL_NAME = "llama-3.3-70b-versatile"
+# Cheap first pass; MODEL_NAME is only used when its output fails validation
+FAST_MODEL = "llama-3.1-8b-instant"
+# The cached tags come from the tiered pipeline, not a single model
+CACHE_MODEL_KEY = f"{FAST_MODEL}->{MODEL_NAME}"
 
-def get_dense_tags(poem_text):
+# Bump whenever the system/user prompt changes; invalidates ExtractionCache entries
+PROMPT_VERSION = "v4"
+
+# Cap on completion length; also what each request reserves from the TPM budget.
+# Leaves room for the step-by-step `reasoning` field ahead of the tags.
+MAX_COMPLETION_TOKENS = 768
+
+# Block size for scanning the checkpoint backwards for a torn tail
+READ_CHUNK_SIZE = 1 << 16
+
+# Retries on the same model (with the validation errors fed back) before escalating
+MAX_VALIDATION_ATTEMPTS = 2
+
+class PoemTags(BaseModel):
+    # First on purpose: the model writes its reasoning before committing to tags
+    reasoning: str = Field(
+        description="Step-by-step scratchpad: imagery, metaphors and emotional arc, worked through before tagging."
+    )
+    concrete_nouns: conlist(str, min_length=5, max_length=7) = Field(
+        description="Highly specific physical objects visible in the poem's imagery."
+    )
+    themes: conlist(str, min_length=4, max_length=6) = Field(
+        description="Complex, abstract concepts the poem explores."
+    )
+    mood: conlist(str, min_length=3, max_length=3) = Field(
+        description="Nuanced emotional adjectives."
+    )
+    analysis_summary: str = Field(
+        description="A single sentence explaining the poem's deeper meaning."
+    )
+
+# The API constrains the model's arguments to this schema, so it no longer
+# needs to be spelled out in every prompt.
+TAGS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "extract_tags",
+        "description": "Record the dense literary tags for the poem.",
+        "parameters": PoemTags.model_json_schema()
+    }
+}
+TAGS_TOOL_CHOICE = {"type": "function", "function": {"name": "extract_tags"}}
+TAGS_TOOL_TOKENS = len(orjson.dumps(TAGS_TOOL)) // 4
+
+class RateLimiter:
     """
-    Uses the dense prompt strategy with the reliable Llama 3.3 70B model.
+    Token-bucket throttle for Groq's requests-per-minute and tokens-per-minute limits.
+    Both buckets refill continuously; a request waits until both can cover it.
     """
-    system_prompt = """
-    You are a literary scholar analyzing Emily Dickinson. Prioritize deep subtext, hidden metaphors, and emotional arc in your analysis. Your final output MUST be a JSON object conforming strictly to the schema.
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60
+        )
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            async with self._lock:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+                # Sleep exactly until the scarcer bucket has refilled enough
+                wait = max(
+                    (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute,
+                    (tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+                )
+            await asyncio.sleep(wait)
+
+    async def observe(self, headers):
+        """
+        Re-syncs the token bucket with what Groq reports as left in this minute
+        (x-ratelimit-remaining-tokens). The local estimate reserves the full
+        completion budget per request, so the server figure is usually higher
+        and requests stop waiting on capacity that was never actually spent.
+        """
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        async with self._lock:
+            self._refill()
+            self.available_token_capacity = min(self.max_tokens_per_minute, remaining)
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+def wait_retry_after(retry_state) -> float:
+    """On a 429, sleep exactly as long as the server's retry-after asks; otherwise back off."""
+    error = retry_state.outcome.exception()
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60)
+    except (TypeError, ValueError):
+        return _backoff(retry_state)
+
+class ExtractionCache:
     """
-    
-    user_prompt = f"""
-    INSTRUCTIONS:
-    1. Analyze the poem deeply to understand its metaphors.
-    2. Extract 'Dense Data' based on that complex understanding.
-
-    Return JSON ONLY with this schema:
-    {{
-        "concrete_nouns": ["list", "of", "5-7", "highly_specific", "physical_objects", "visible_in_imagery"],
-        "themes": ["list", "of", "4-6", "complex", "abstract", "concepts"],
-        "mood": ["list", "of", "3", "nuanced", "emotional", "adjectives"],
-        "analysis_summary": "A single sentence explaining the poem's deeper meaning."
-    }}
-
-    POEM:
-    {poem_text}
+    Content-addressed cache of extracted tags, one JSON file per
+    (model, prompt version, poem text). Re-runs with reordered input or new
+    filters only pay for poems that were never tagged under this prompt.
     """
-    try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1, 
-            response_format={"type": "json_object"} 
-        )
-        return json.loads(completion.choices[0].message.content)
-        
-    except Exception as e:
-        print(f"Error extracting tags: {e}")
-        return None
 
-def load_existing_data(output_file):
-    if os.path.exists(output_file):
+    def __init__(self, cache_dir=".extract_cache"):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, poem_text, model):
+        key = hashlib.sha256(f"{model}|{PROMPT_VERSION}|{poem_text}".encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, poem_text, model=MODEL_NAME):
         try:
-            with open(output_file, "r", encoding="utf-8") as f:
-                return json.loads(f.read().strip() or "[]")
-        except:
-            return []
-    return []
+            return orjson.loads(self._path(poem_text, model).read_bytes())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return None
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True, help="Cleaned .txt file")
-    parser.add_argument("--output", required=True, help="Output .json file")
-    parser.add_argument("--loose", action="store_true", help="Disable strict line-length checks (for Whitman)")
-    args = parser.parse_args()
+    def put(self, poem_text, tags, model=MODEL_NAME):
+        # Write-then-rename so a crash never leaves a half-written entry
+        path = self._path(poem_text, model)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(orjson.dumps(tags))
+        tmp.replace(path)
 
-    if not os.path.exists(args.input):
-        print(f"File not found: {args.input}")
+SYSTEM_PROMPT = """
+You are a literary scholar analyzing Emily Dickinson. Prioritize deep subtext, hidden metaphors, and emotional arc in your analysis. Record your analysis by calling the extract_tags tool. Think step-by-step inside `reasoning`, then fill the remaining fields.
+
+INSTRUCTIONS:
+1. Analyze each poem the user sends deeply to understand its metaphors.
+2. Extract 'Dense Data' based on that complex understanding.
+"""
+
+EXAMPLE_POEM = """"Hope" is the thing with feathers -
+That perches in the soul -
+And sings the tune without the words -
+And never stops - at all -
+
+And sweetest - in the Gale - is heard -
+And sore must be the storm -
+That could abash the little Bird
+That kept so many warm -
+
+I've heard it in the chillest land -
+And on the strangest Sea -
+Yet - never - in Extremity,
+It asked a crumb - of me."""
+
+EXAMPLE_TAGS = {
+    "reasoning": "Hope is figured as a small bird living in the soul. It sings without words and never stops, "
+                 "is loudest in the gale, and survives cold land and strange sea. The last lines turn to its "
+                 "generosity: it sustains the speaker yet never asks anything back.",
+    "concrete_nouns": ["feathers", "bird", "gale", "storm", "sea", "crumb"],
+    "themes": ["hope as inner resilience", "wordless music of the soul", "endurance through adversity", "unasked generosity"],
+    "mood": ["consoling", "resilient", "tender"],
+    "analysis_summary": "Hope is a tireless inner bird that sings loudest in hardship and asks nothing in return."
+}
+
+# Identical leading turns on every request: instructions and a one-shot example
+# are sent verbatim each time, so each poem only adds one short user turn.
+PROMPT_PREFIX = [
+    {"role": "system", "content": SYSTEM_PROMPT},
+    {"role": "user", "content": EXAMPLE_POEM},
+    {"role": "assistant", "content": "", "tool_calls": [{
+        "id": "call_example",
+        "type": "function",
+        "function": {"name": "extract_tags", "arguments": orjson.dumps(EXAMPLE_TAGS).decode()}
+    }]},
+    {"role": "tool", "tool_call_id": "call_example", "content": "Recorded."}
+]
+
+def estimate_tokens(messages) -> int:
+    """Rough prompt + tool schema size (~4 chars/token) plus the completion reservation."""
+    chars = 0
+    for m in messages:
+        chars += len(m["content"])
+        chars += sum(len(call["function"]["arguments"]) for call in m.get("tool_calls", ()))
+    return chars // 4 + TAGS_TOOL_TOKENS + MAX_COMPLETION_TOKENS
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def request_completion(messages, limiter: RateLimiter, model: str = MODEL_NAME):
+    await limiter.acquire(estimate_tokens(messages))
+    # Raw response so the rate-limit headers can feed back into the limiter
+    response = await client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        temperature=0.1,
+        max_tokens=MAX_COMPLETION_TOKENS,
+        tools=[TAGS_TOOL],
+        tool_choice=TAGS_TOOL_CHOICE
+    )
+    await limiter.observe(response.headers)
+    return await response.parse()
+
+async def get_dense_tags(poem_text, limiter: RateLimiter, model: str = MODEL_NAME):
+    """
+    Uses the dense prompt strategy with the given model (Llama 3.3 70B by default).
+    Returns validated PoemTags as a dict (without the `reasoning` scratchpad),
+    or None if the model never produced them.
+    """
+    messages = PROMPT_PREFIX + [{"role": "user", "content": poem_text}]
+
+    for attempt in range(MAX_VALIDATION_ATTEMPTS):
+        try:
+            completion = await request_completion(messages, limiter, model=model)
+            arguments = completion.choices[0].message.tool_calls[0].function.arguments
+        except Exception as e:
+            print(f"Error extracting tags ({model}): {e}")
+            return None
+
+        try:
+            # The scratchpad only exists to improve the tags; downstream records stay unchanged
+            return PoemTags.model_validate_json(arguments).model_dump(exclude={"reasoning"})
+        except ValidationError as e:
+            print(f"  {model} output failed validation ({e.error_count()} errors, attempt {attempt + 1}).")
+            # Retry with feedback: show the model its own arguments and what was wrong
+            messages = messages[:len(PROMPT_PREFIX) + 1] + [
+                {"role": "assistant", "content": arguments},
+                {"role": "user", "content": f"That extract_tags call was invalid:\n{e}\nCall extract_tags again with corrected arguments."}
+            ]
+
+    return None
+
+async def try_fast_then_escalate(poem_text, limiters):
+    """
+    Tags the poem with FAST_MODEL and only escalates to MODEL_NAME when the
+    fast model fails or still returns invalid tags after feedback.
+    """
+    for model in (FAST_MODEL, MODEL_NAME):
+        tags = await get_dense_tags(poem_text, limiters[model], model=model)
+        if tags is not None:
+            return tags
+    return None
+
+def prepare_checkpoint(output_file) -> bool:
+    """
+    Makes the JSONL checkpoint safe to append to. A torn last line from an
+    interrupted run is truncated away (that poem is redone), so the next record
+    isn't glued onto it. Returns False for a legacy JSON-array file, which
+    must not be appended to.
+    """
+    if not os.path.exists(output_file):
+        return True
+    with open(output_file, "r+b") as f:
+        if f.read(64).lstrip().startswith(b"["):
+            print(f"[ERROR] {output_file} is a JSON array, not a JSONL checkpoint.")
+            print("        Point --output at a .jsonl file (use --compact-json for the array).")
+            return False
+
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return True
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return True
+
+        # Walk back to the last complete line
+        keep, pos = 0, size
+        while pos > 0:
+            step = min(READ_CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                keep = pos + newline + 1
+                break
+        print(f"  Dropping torn checkpoint tail ({size - keep} bytes); that poem will be redone.")
+        f.truncate(keep)
+    return True
+
+def load_existing_data(output_file):
+    """
+    Yields the records of a JSONL checkpoint (one JSON object per line).
+    Unreadable lines are skipped; their poems are redone.
+    """
+    if not os.path.exists(output_file):
         return
+    with open(output_file, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(f"  Ignoring unreadable checkpoint line: {line[:60]!r}...")
+
+def compact_to_json(jsonl_file, json_file):
+    """
+    Emits the legacy JSON array (sorted by id) that vector_loader.load_data reads.
+    """
+    records = sorted(load_existing_data(jsonl_file), key=lambda r: r["id"])
+    with open(json_file, "wb") as f:
+        f.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
+    print(f"Wrote {len(records)} records to {json_file}")
 
+async def run(args):
     print("Loading poems...")
     with open(args.input, "r", encoding="utf-8") as f:
         all_poems = f.read().split("\n---POEM_SEPARATOR---\n")
 
-    processed_data = load_existing_data(args.output)
-    start_index = len(processed_data)
-    
-    print(f"Resuming from index {start_index}...")
+    if not prepare_checkpoint(args.output):
+        return
+
+    # Completions arrive out of order, so resume by id rather than by position
+    done_ids = {record.get("id") for record in load_existing_data(args.output)}
+    pending = [i for i in range(len(all_poems)) if f"poem_{i:04d}" not in done_ids]
 
-    for i in range(start_index, len(all_poems)):
+    print(f"Resuming: {len(done_ids)} done, {len(pending)} pending...")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    # Groq rate limits are per model
+    limiters = {model: RateLimiter(args.max_rpm, args.max_tpm) for model in (FAST_MODEL, MODEL_NAME)}
+    cache = ExtractionCache(args.cache_dir)
+    completed = 0
+
+    # Append-only sink: each record is written once, never re-serialized
+    out_fh = open(args.output, "ab", buffering=1 << 16)
+
+    def record(entry):
+        # No await between write and count, so coroutines can't interleave here
+        nonlocal completed
+        out_fh.write(orjson.dumps(entry) + b"\n")
+        completed += 1
+        if completed % args.checkpoint_every == 0:
+            out_fh.flush()
+
+    async def bounded_extract(i):
         poem = all_poems[i].strip()
-        
+
         # --- LOGIC UPDATE FOR WHITMAN ---
         lines = poem.split('\n')
         avg_line_len = sum(len(l) for l in lines) / len(lines) if lines else 0
-        
+
         # If --loose is set (Whitman), we allow longer lines (up to 200 chars)
-        max_len = 200 if args.loose else 65 
-        
+        max_len = 200 if args.loose else 65
+
         if len(poem) < 10 or avg_line_len > max_len:
             print(f"  Skipping Poem #{i+1} (Filter: {avg_line_len:.1f} chars/line)")
-            processed_data.append({"id": f"poem_{i:04d}", "status": "skipped"})
             # Save placeholder to maintain index alignment
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(processed_data, f, indent=2)
-            continue
+            record({"id": f"poem_{i:04d}", "status": "skipped"})
+            return True
+
+        tags = cache.get(poem, model=CACHE_MODEL_KEY)
+        if tags:
+            print(f"Tagging Poem #{i+1}... (cached)")
+        else:
+            async with semaphore:
+                print(f"Tagging Poem #{i+1}...")
+                tags = await try_fast_then_escalate(poem, limiters)
+            if tags:
+                cache.put(poem, tags, model=CACHE_MODEL_KEY)
 
-        print(f"Tagging Poem #{i+1}...")
-        tags = get_dense_tags(poem)
-        
         if tags:
-            processed_data.append({
+            record({
                 "id": f"poem_{i:04d}",
                 "text": poem,
-                "metadata": tags 
+                "metadata": tags
             })
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(processed_data, f, indent=2)
-            time.sleep(0.5)
-        else:
-            print("Failed. Saving and stopping.")
-            break
+            return True
+
+        print(f"  Failed Poem #{i+1}. It will be retried on the next run.")
+        return False
+
+    try:
+        results = await asyncio.gather(*(bounded_extract(i) for i in pending))
+    finally:
+        out_fh.close()
+
+    failed = results.count(False)
+    print(f"Done. {len(results) - failed} processed, {failed} failed.")
+
+    if args.compact_json:
+        compact_to_json(args.output, args.compact_json)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="Cleaned .txt file")
+    parser.add_argument("--output", required=True, help="Output .jsonl checkpoint (appended to, used for resume)")
+    parser.add_argument("--compact-json", help="Also write the final records as a JSON array (for vector_loader)")
+    parser.add_argument("--loose", action="store_true", help="Disable strict line-length checks (for Whitman)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max in-flight Groq requests")
+    parser.add_argument("--max-rpm", type=float, default=30, help="Groq requests-per-minute limit (per model)")
+    parser.add_argument("--max-tpm", type=float, default=12000, help="Groq tokens-per-minute limit (per model)")
+    parser.add_argument("--cache-dir", default=".extract_cache", help="Content-addressed cache of extracted tags")
+    parser.add_argument("--checkpoint-every", type=int, default=25, help="Flush the checkpoint every K completions")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"File not found: {args.input}")
+        return
+
+    asyncio.run(run(args))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,17 @@
 import os
-from typing import List, Dict, Any
+import sqlite3
+import asyncio
+import functools
+import orjson
+from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
-from pinecone import Pinecone
-import google.generativeai as genai
+# gRPC transport: persistent HTTP/2 channel + protobuf, lower per-query overhead than REST
+try:
+    from pinecone.grpc import PineconeGRPC as Pinecone
+except ImportError:
+    from pinecone import Pinecone
+from google import genai
+from google.genai import types
 
 load_dotenv()
 
@@ -13,43 +22,102 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 # Best Practice: Fallback to v2 if .env is missing, but prefer env var
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "poetic-camera-v2")
 
+# The only metadata the app consumes (reranker, context panel, generator)
+METADATA_FIELDS = ("title", "text")
+
+# Full poem texts written by vector_loader; vectors only carry a preview
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+POEM_STORE_PATH = os.getenv(
+    "POEM_STORE_PATH",
+    os.path.join(DATA_DIR, "poems.db")
+)
+# Source of truth when the sidecar is missing (namespace -> metadata JSON)
+POEM_SOURCE_FILES = {
+    "dickinson": os.path.join(DATA_DIR, "dickinson_metadata_dense.json"),
+    "shelley": os.path.join(DATA_DIR, "PercyByssheShelley_dense.json"),
+}
+
 # Initialize Systems
 print(f"Connecting to Pinecone Index: {PINECONE_INDEX_NAME}...")
 pc = Pinecone(api_key=PINECONE_API_KEY)
 index = pc.Index(PINECONE_INDEX_NAME)
 
 print("Connecting to Gemini Embeddings...")
-genai.configure(api_key=GEMINI_API_KEY)
+# Module-level client: query embeddings reuse its pooled connection
+genai_client = genai.Client(api_key=GEMINI_API_KEY)
 
 def get_embedding(text: str) -> List[float]:
     """Generates embedding using Gemini to match your database schema."""
     try:
-        result = genai.embed_content(
+        result = genai_client.models.embed_content(
             model="models/text-embedding-004",
-            content=text,
-            task_type="retrieval_query" 
+            contents=text,
+            config=types.EmbedContentConfig(task_type="RETRIEVAL_QUERY")
         )
-        return result['embedding']
+        return result.embeddings[0].values
     except Exception as e:
         print(f"Embedding Error: {e}")
         return []
 
-def retrieve_poems(query_narrative: str, top_k=3, namespace=None) -> List[Dict[str, Any]]:
+@functools.lru_cache(maxsize=None)
+def _source_texts(namespace) -> Dict[str, str]:
     """
-    Pure Vector Search. Fast and efficient.
+    id -> text from the committed metadata JSON, loaded once per namespace.
+    Only used when the sidecar can't answer, e.g. a deploy without poems.db.
     """
-    print(f"\nSearching Pinecone '{PINECONE_INDEX_NAME}' for: '{query_narrative}' (Namespace: {namespace})")
+    path = POEM_SOURCE_FILES.get(namespace)
+    if not path or not os.path.exists(path):
+        print(f"[!] WARNING: No poem store or source JSON for '{namespace}'. References will be truncated previews.")
+        return {}
+    print(f"[!] WARNING: Poem store {POEM_STORE_PATH} is missing texts for '{namespace}'; loading them from {path}.")
+    with open(path, "rb") as f:
+        poems = orjson.loads(f.read())
+    return {p["id"]: p["text"] for p in poems if p.get("id") and p.get("text")}
 
-    vector = get_embedding(query_narrative)
-    if not vector:
-        return []
-    
+def _store_texts(ids: List[str], namespace) -> Optional[Dict[str, str]]:
+    """One read-only sidecar query; None when the store is missing or unreadable."""
+    try:
+        # Opened per call: queries run on worker threads
+        conn = sqlite3.connect(f"file:{POEM_STORE_PATH}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        placeholders = ",".join("?" * len(ids))
+        rows = conn.execute(
+            f"SELECT id, text FROM poems WHERE namespace = ? AND id IN ({placeholders})",
+            [namespace or "", *ids]
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Poem Store Error: {e}")
+        return None
+    finally:
+        conn.close()
+    return dict(rows)
+
+def fetch_texts(ids: List[str], namespace=None) -> Dict[str, str]:
+    """
+    Looks up full poem texts in the local sidecar, falling back to the source
+    JSON for any id the sidecar doesn't have.
+    """
+    if not ids:
+        return {}
+    texts = _store_texts(ids, namespace) or {}
+    missing = [i for i in ids if i not in texts]
+    if missing:
+        source = _source_texts(namespace)
+        texts.update((i, source[i]) for i in missing if i in source)
+    return texts
+
+def query_namespace(vector: List[float], top_k: int, namespace=None) -> List[Dict[str, Any]]:
+    """
+    Runs a single Pinecone query for a precomputed embedding.
+    """
     try:
         results = index.query(
             vector=vector,
             top_k=top_k,
             include_metadata=True,
-            include_values=False, # OPTIMIZATION: Set to False to save bandwidth
+            include_values=False, # OPTIMIZATION: Only metadata is consumed; skip the vector payload
             namespace=namespace
         )
     except Exception as e:
@@ -57,21 +125,59 @@ def retrieve_poems(query_narrative: str, top_k=3, namespace=None) -> List[Dict[s
         return []
     
     if not results['matches']:
-        print("No matches found.")
+        print(f"No matches found (Namespace: {namespace}).")
         return []
 
+    texts = fetch_texts([match['id'] for match in results['matches']], namespace)
+
     found_poems = []
-    print("\nTop chunckes using bi-encoder cosine similarity search:")
+    print(f"\nTop chunckes using bi-encoder cosine similarity search (Namespace: {namespace}):")
     print(f"Found {len(results['matches'])} matches.")
     
     for match in results['matches']:
-        found_poems.append(match)
-        title = match['metadata'].get('title', 'Unknown')
+        # Project to plain dicts with just the fields we use; these are held in
+        # session state for every poet, so unused metadata is pure overhead.
+        metadata = dict(match['metadata'] or {})
+        # Older vectors still carry the full text; newer ones only a preview
+        metadata['text'] = texts.get(match['id']) or metadata.get('text') or metadata.get('preview', '')
+        found_poems.append({
+            "id": match['id'],
+            "score": match['score'],
+            "metadata": {k: metadata[k] for k in METADATA_FIELDS if k in metadata}
+        })
+        title = metadata.get('title', 'Unknown')
         score = match['score']
         print(f"   ★ {title} (Similarity: {score:.4f})")
         
     return found_poems
 
+def retrieve_poems(query_narrative: str, top_k=3, namespace=None) -> List[Dict[str, Any]]:
+    """
+    Pure Vector Search. Fast and efficient.
+    """
+    print(f"\nSearching Pinecone '{PINECONE_INDEX_NAME}' for: '{query_narrative}' (Namespace: {namespace})")
+
+    vector = get_embedding(query_narrative)
+    if not vector:
+        return []
+    
+    return query_namespace(vector, top_k, namespace)
+
+def query_namespaces(vector: List[float], namespaces: List[str], top_k=3) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Queries every namespace concurrently with a precomputed embedding, so the
+    candidates for all poets arrive in roughly one round trip.
+    """
+    if not vector:
+        return {ns: [] for ns in namespaces}
+
+    async def fan_out():
+        return await asyncio.gather(
+            *(asyncio.to_thread(query_namespace, vector, top_k, ns) for ns in namespaces)
+        )
+
+    return dict(zip(namespaces, asyncio.run(fan_out())))
+
 if __name__ == "__main__":
     # Test
     retrieve_poems("A Serene poem about Nature and Solitude.")
\ No newline at end of file
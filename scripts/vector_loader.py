@@ -1,11 +1,20 @@
-import json
+import orjson
 import os
+import sqlite3
 import argparse
-import time
+import asyncio
+from collections import deque
 from typing import List, Dict, Any
+from tenacity import retry, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
-from pinecone import Pinecone, ServerlessSpec
-import google.generativeai as genai
+from pinecone import ServerlessSpec
+# gRPC transport: vectors go over the wire as protobuf instead of JSON
+try:
+    from pinecone.grpc import PineconeGRPC as Pinecone
+except ImportError:
+    from pinecone import Pinecone
+from google import genai
+from google.genai import types
 
 load_dotenv()
 
@@ -14,95 +23,235 @@ PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME") # Picked up from .env
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# text-embedding-004 emits 768-d vectors; the index must match exactly
+EMBEDDING_DIM = 768
+PINECONE_CLOUD = os.getenv("PINECONE_CLOUD", "aws")
+PINECONE_REGION = os.getenv("PINECONE_REGION", "us-east-1")
+
 if not PINECONE_API_KEY or not GEMINI_API_KEY:
     raise ValueError("Missing API Keys! Check your .env file.")
 
+BATCH_SIZE = 100         # vectors per Pinecone upsert
+EMBED_BATCH_SIZE = 100   # texts per Gemini embed call (API maximum)
+EMBED_CONCURRENCY = 4    # embed calls in flight
+UPSERT_WINDOW = 4        # upserts in flight
+
+# Full poem texts live in a local SQLite sidecar; Pinecone only gets a preview
+POEM_STORE_PATH = os.getenv(
+    "POEM_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "poems.db")
+)
+PREVIEW_CHARS = 240
+
 # Initialize Clients
 print(f"Connecting to Pinecone Index: {PINECONE_INDEX_NAME}...")
 pc = Pinecone(api_key=PINECONE_API_KEY)
+
+# Build the index on first run: serverless, cosine, sized to the embedding model
+# (list_indexes().names() rather than has_index, which needs pinecone >= 5.4)
+if PINECONE_INDEX_NAME not in pc.list_indexes().names():
+    print(f"Creating serverless index '{PINECONE_INDEX_NAME}' ({EMBEDDING_DIM}-d, cosine)...")
+    pc.create_index(
+        name=PINECONE_INDEX_NAME,
+        dimension=EMBEDDING_DIM,
+        metric="cosine",
+        spec=ServerlessSpec(cloud=PINECONE_CLOUD, region=PINECONE_REGION)
+    )
+
 index = pc.Index(PINECONE_INDEX_NAME)
 
 print("Connecting to Gemini...")
-genai.configure(api_key=GEMINI_API_KEY)
+# One client for the whole run: its HTTP connection pool is reused by every embed call
+genai_client = genai.Client(api_key=GEMINI_API_KEY)
 
 def build_semantic_string(poem_obj: Dict[str, Any]) -> str:
     """
     Converts metadata into a search-optimized string.
     """
     meta = poem_obj.get("metadata", {})
-    noun_str = ", ".join(meta.get("concrete_nouns", []))
-    theme_str = ", ".join(meta.get("themes", []))
-    mood_str = ", ".join(meta.get("mood", []))
-    
+
     # We construct a sentence that mimics a user's potential query
-    narrative = f"A {mood_str} poem about {theme_str}, featuring imagery of {noun_str}."
-    return narrative
+    return "".join([
+        "A ", ", ".join(meta.get("mood", [])),
+        " poem about ", ", ".join(meta.get("themes", [])),
+        ", featuring imagery of ", ", ".join(meta.get("concrete_nouns", [])), "."
+    ])
+
+def store_texts(poems: List[Dict[str, Any]], namespace: str):
+    """
+    Writes id -> full text into the sidecar the retriever reads from.
+    Keyed by namespace too, since every author's poem ids start at poem_0000.
+    """
+    with sqlite3.connect(POEM_STORE_PATH) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS poems ("
+            "namespace TEXT NOT NULL, id TEXT NOT NULL, text TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, id))"
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO poems (namespace, id, text) VALUES (?, ?, ?)",
+            [(namespace, p.get("id"), p.get("text") or "") for p in poems]
+        )
+    conn.close()
+
+@retry(wait=wait_random_exponential(min=1, max=30), stop=stop_after_attempt(5), reraise=True)
+def embed_documents(texts: List[str]) -> List[List[float]]:
+    """One round trip for up to EMBED_BATCH_SIZE texts."""
+    response = genai_client.models.embed_content(
+        model="models/text-embedding-004",
+        contents=texts,
+        config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT")
+    )
+    return [embedding.values for embedding in response.embeddings]
+
+@retry(wait=wait_random_exponential(min=1, max=30), stop=stop_after_attempt(5), reraise=True)
+def upsert_batch(vectors: List[Dict[str, Any]], namespace: str):
+    index.upsert(vectors=vectors, namespace=namespace)
+
+async def embed_worker(poems: List[Dict[str, Any]], namespace: str, semaphore: asyncio.Semaphore, queue: asyncio.Queue, dropped: List[str]):
+    """
+    Producer: embeds a chunk of poems in one call (SDK is sync, so on a worker
+    thread) and queues one payload per poem. Ids of a failed chunk go to dropped.
+    """
+    semantic_texts = [build_semantic_string(p) for p in poems]
+
+    # 1. Generate Embeddings
+    async with semaphore:
+        try:
+            embeddings = await asyncio.to_thread(embed_documents, semantic_texts)
+        except Exception as e:
+            print(f" [!] Embedding failed for IDs {poems[0].get('id')}..{poems[-1].get('id')}: {e}")
+            dropped.extend(p.get("id") for p in poems)
+            return
+
+    # 2. Build Payloads
+    for poem, semantic_text, embedding in zip(poems, semantic_texts, embeddings):
+        metadata = {
+            # Full text is in the sidecar; the preview keeps hits readable without it
+            "preview": (poem.get("text") or "")[:PREVIEW_CHARS],
+            "title": f"Poem {poem.get('id')}",
+            "semantic_string": semantic_text,
+            "author": namespace # Tagging the author is crucial for multi-tenancy
+        }
+
+        await queue.put({
+            "id": poem.get("id"),
+            "values": embedding,
+            "metadata": metadata
+        })
+
+async def upserter(queue: asyncio.Queue, namespace: str, total: int, dropped: List[str]):
+    """
+    Consumer: drains the queue into BATCH_SIZE batches and keeps up to
+    UPSERT_WINDOW async upserts in flight. The window itself is the backpressure.
+    """
+    batch = []
+    inflight = deque()
+    uploaded = 0
 
-def load_data(json_file: str, namespace: str):
+    def mark_uploaded(vectors):
+        nonlocal uploaded
+        uploaded += len(vectors)
+        print(f"   ✓ Uploaded batch {uploaded}/{total}")
+
+    def retry_sequentially(vectors, error):
+        # Only a failed batch falls back to a sequential, backed-off retry
+        print(f"   [!] Pinecone Upload Error: {error}. Retrying batch sequentially...")
+        try:
+            upsert_batch(vectors, namespace)
+        except Exception as e:
+            print(f"   [!] Pinecone Upload Error: {e}. Dropping {len(vectors)} vectors.")
+            dropped.extend(v["id"] for v in vectors)
+            return
+        mark_uploaded(vectors)
+
+    def settle_oldest():
+        result, vectors = inflight.popleft()
+        try:
+            # gRPC upserts return futures, REST upserts return ApplyResults
+            result.result() if hasattr(result, "result") else result.get()
+        except Exception as e:
+            retry_sequentially(vectors, e)
+            return
+        mark_uploaded(vectors)
+
+    async def flush():
+        nonlocal batch
+        vectors, batch = batch, []
+        if len(inflight) >= UPSERT_WINDOW:
+            await asyncio.to_thread(settle_oldest)
+        try:
+            result = index.upsert(vectors=vectors, namespace=namespace, async_req=True)
+        except Exception as e:
+            # The request can fail before it is ever sent (e.g. payload conversion)
+            await asyncio.to_thread(retry_sequentially, vectors, e)
+            return
+        inflight.append((result, vectors))
+
+    # 3. Upsert Batch
+    while (payload := await queue.get()) is not None:
+        batch.append(payload)
+        if len(batch) >= BATCH_SIZE:
+            await flush()
+
+    # 4. Final Batch
+    if batch:
+        await flush()
+    while inflight:
+        await asyncio.to_thread(settle_oldest)
+
+async def run_pipeline(valid_poems: List[Dict[str, Any]], namespace: str) -> List[str]:
+    """Embeds and upserts every poem; returns the ids that were dropped after retries."""
+    dropped = []
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    queue = asyncio.Queue(maxsize=BATCH_SIZE * 2)
+
+    chunks = [valid_poems[i:i + EMBED_BATCH_SIZE] for i in range(0, len(valid_poems), EMBED_BATCH_SIZE)]
+
+    async def produce():
+        await asyncio.gather(*(embed_worker(chunk, namespace, semaphore, queue, dropped) for chunk in chunks))
+        await queue.put(None)
+
+    consumer = asyncio.create_task(upserter(queue, namespace, len(valid_poems), dropped))
+    producer = asyncio.create_task(produce())
+    try:
+        await asyncio.gather(consumer, producer)
+    except BaseException:
+        # A dead consumer would leave the producers blocked on the full queue forever
+        consumer.cancel()
+        producer.cancel()
+        raise
+    return dropped
+
+def load_data(json_file: str, namespace: str) -> bool:
     print(f"\n--- INGESTION PROTOCOL STARTED ---")
     print(f"Target Namespace: '{namespace}'")
     print(f"Source File:      {json_file}")
     
     if not os.path.exists(json_file):
         print(f"[ERROR] File not found: {json_file}")
-        return
+        return False
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        poems = json.load(f)
+    with open(json_file, "rb") as f:
+        poems = orjson.loads(f.read())
         
     # Filter out skipped items (from the prose filter)
     valid_poems = [p for p in poems if p.get("status") != "skipped"]
     print(f"Loaded {len(valid_poems)} valid poems (out of {len(poems)} total).")
 
-    batch_size = 50
-    vectors_to_upsert = []
-
-    print("Starting Embedding & Upload Loop...")
-
-    for i, poem in enumerate(valid_poems):
-        semantic_text = build_semantic_string(poem)
-        
-        # 1. Generate Embedding
-        try:
-            response = genai.embed_content(
-                model="models/text-embedding-004",
-                content=semantic_text,
-                task_type="retrieval_document" 
-            )
-            embedding = response['embedding']
-        except Exception as e:
-            print(f" [!] Embedding failed for ID {poem.get('id')}: {e}")
-            continue
+    store_texts(valid_poems, namespace)
+    print(f"Stored full texts in {POEM_STORE_PATH}")
 
-        # 2. Build Payload
-        vector_payload = {
-            "id": poem.get("id"), 
-            "values": embedding,
-            "metadata": {
-                "text": poem.get("text"),
-                "title": f"Poem {poem.get('id')}",
-                "semantic_string": semantic_text,
-                "author": namespace # Tagging the author is crucial for multi-tenancy
-            }
-        }
-        vectors_to_upsert.append(vector_payload)
-
-        # 3. Upsert Batch
-        if len(vectors_to_upsert) >= batch_size:
-            try:
-                index.upsert(vectors=vectors_to_upsert, namespace=namespace)
-                print(f"   ✓ Uploaded batch {i+1}/{len(valid_poems)}")
-                vectors_to_upsert = [] # Reset
-                time.sleep(0.5) # Rate limit safety
-            except Exception as e:
-                 print(f"   [!] Pinecone Upload Error: {e}")
+    print("Starting Embedding & Upload Pipeline...")
+    dropped = asyncio.run(run_pipeline(valid_poems, namespace))
 
-    # 4. Final Batch
-    if vectors_to_upsert:
-        index.upsert(vectors=vectors_to_upsert, namespace=namespace)
-        print(f"   ✓ Uploaded final batch.")
+    if dropped:
+        print(f"--- INCOMPLETE: {len(dropped)} poems were not uploaded to '{namespace}'. Re-run to retry: ---")
+        print(", ".join(sorted(dropped)))
+        return False
 
     print(f"--- SUCCESS: Namespace '{namespace}' is ready. ---")
+    return True
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -110,4 +259,5 @@ if __name__ == "__main__":
     parser.add_argument("--namespace", required=True, help="Target Pinecone namespace (e.g. 'dickinson', 'poe')")
     args = parser.parse_args()
     
-    load_data(args.file, args.namespace)
\ No newline at end of file
+    if not load_data(args.file, args.namespace):
+        raise SystemExit(1)
\ No newline at end of file
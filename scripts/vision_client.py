@@ -2,6 +2,8 @@ import os
 import json
 import base64
 import io
+import struct
+from typing import Optional, Tuple
 from dotenv import load_dotenv
 from groq import Groq
 from PIL import Image
@@ -10,20 +12,58 @@ load_dotenv()
 VISION_MODEL_ID = "meta-llama/llama-4-scout-17b-16e-instruct" 
 client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
-def analyze_image(image_file) -> str:
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# JPEG start-of-frame markers carry the dimensions (C4/C8/CC are not frames)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def get_image_size(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Reads (width, height) straight from the PNG IHDR or JPEG SOF header
+    without decoding the image. Falls back to PIL for other formats.
+    """
+    if image_bytes[:8] == PNG_SIGNATURE and image_bytes[12:16] == b"IHDR":
+        return struct.unpack(">II", image_bytes[16:24])
+
+    if image_bytes[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 <= len(image_bytes):
+            if image_bytes[i] != 0xFF:
+                i += 1
+                continue
+            marker = image_bytes[i + 1]
+            # Fill bytes and standalone markers have no length field
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                i += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", image_bytes[i + 5:i + 9])
+                return width, height
+            i += 2 + struct.unpack(">H", image_bytes[i + 2:i + 4])[0]
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            return img.size
+    except Exception as e:
+        print(f"[WARNING] Could not read image size: {e}")
+        return None
+
+def analyze_image(image_bytes: bytes) -> str:
     """
-    Takes a Streamlit UploadedFile (or file-like object), 
-    processes it, and analyzes it using Groq Vision.
+    Takes the raw bytes of an uploaded image (no temp file round-trip),
+    processes them in memory, and analyzes them using Groq Vision.
     """
     
-    if image_file is None:
+    if not image_bytes:
         return ""
 
     print(f"[SYSTEM] Analyzing image with model: {VISION_MODEL_ID}...")
     
     try:
         # 1. Load and Resize
-        with Image.open(image_file) as img:
+        with Image.open(io.BytesIO(image_bytes)) as img:
             if img.mode != 'RGB':
                 img = img.convert('RGB')
             
@@ -102,6 +142,6 @@ def analyze_image(image_file) -> str:
 if __name__ == "__main__":
     if os.path.exists("test.jpg"):
         with open("test.jpg", "rb") as f:
-            print(analyze_image(f))
+            print(analyze_image(f.read()))
     else:
         print("No test.jpg found.")
\ No newline at end of file